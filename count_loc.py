@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
 import argparse
+import heapq
+import itertools
+import mmap
+import os
+import shutil
+import sqlite3
 import sys
 import tempfile
+import threading
+import time
 import urllib.error
 import urllib.parse
 import urllib.request
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
 from pathlib import Path
 
 
@@ -35,6 +45,13 @@ DEFAULT_EXTENSIONS = {
     ".sql",
 }
 
+READ_CHUNK_BYTES = 1 << 20
+LOC_CACHE_MAX_ROWS = 200_000
+DOWNLOAD_TIMEOUT = 60
+MAX_FILE_BYTES = 4 << 20
+BINARY_SNIFF_BYTES = 4096
+BLANK_BYTES = b" \t\r\x0b\x0c"
+
 DEFAULT_IGNORE_DIRS = {
     ".git",
     "node_modules",
@@ -48,23 +65,89 @@ DEFAULT_IGNORE_DIRS = {
 }
 
 
-def iter_source_files(root: Path, extensions: set[str], ignore_dirs: set[str]):
-    for path in root.rglob("*"):
-        if not path.is_file():
-            continue
-        if any(part in ignore_dirs for part in path.parts):
+def iter_source_files(
+    root: Path,
+    extensions: set[str],
+    ignore_dirs: set[str],
+    max_bytes: int = MAX_FILE_BYTES,
+):
+    # Explicit DFS so ignored directories are pruned instead of walked. Yields
+    # (path, relpath) strings; relpath uses "/" and is built while descending.
+    ext_set = frozenset(extensions)
+    stack = [(str(root), "")]
+    while stack:
+        directory, rel_dir = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError:
             continue
-        if extensions and path.suffix.lower() not in extensions:
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in ignore_dirs:
+                        stack.append((entry.path, f"{rel_dir}{entry.name}/"))
+                    continue
+                if not entry.is_file():
+                    continue
+                if ext_set:
+                    name = entry.name
+                    dot = name.rfind(".")
+                    if dot <= 0 or name[dot:].lower() not in ext_set:
+                        continue
+                if max_bytes:
+                    try:
+                        size = entry.stat().st_size
+                    except OSError:
+                        continue
+                    if size > max_bytes:
+                        continue
+                yield entry.path, rel_dir + entry.name
+
+
+def _count_chunks(chunks) -> int:
+    # After deleting blanks only b"\n" is left as whitespace, so bytes.split()
+    # yields exactly the non-empty lines. A line cut by a chunk boundary would
+    # be seen twice, hence the correction for the previous unterminated tail.
+    count = 0
+    open_line = False
+    for chunk in chunks:
+        text = chunk.translate(None, BLANK_BYTES)
+        if not text:
             continue
-        yield path
+        count += len(text.split())
+        if open_line and text[0] != 10:
+            count -= 1
+        open_line = text[-1] != 10
+    return count
+
+
+def _count_stream(stream) -> int:
+    head = stream.read(READ_CHUNK_BYTES)
+    if head.find(b"\x00", 0, BINARY_SNIFF_BYTES) != -1:
+        return 0
+    rest = iter(lambda: stream.read(READ_CHUNK_BYTES), b"")
+    return _count_chunks(itertools.chain((head,), rest))
 
 
-def count_non_empty_lines(path: Path) -> int:
+def count_non_empty_lines(path: str | Path) -> int:
     try:
-        text = path.read_text(encoding="utf-8", errors="ignore")
-    except OSError:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return 0
+            if size <= READ_CHUNK_BYTES:
+                # One read() is cheaper than setting up a mapping for small files.
+                return _count_stream(f)
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                # Same heuristic as git: a NUL byte near the start means binary.
+                if mm.find(b"\x00", 0, BINARY_SNIFF_BYTES) != -1:
+                    return 0
+                return _count_chunks(
+                    mm[start : start + READ_CHUNK_BYTES]
+                    for start in range(0, size, READ_CHUNK_BYTES)
+                )
+    except (OSError, ValueError):
         return 0
-    return sum(1 for line in text.splitlines() if line.strip())
 
 
 def parse_csv_set(value: str) -> set[str]:
@@ -76,17 +159,142 @@ def normalize_extensions(exts: set[str]) -> set[str]:
     return {ext if ext.startswith(".") else f".{ext}" for ext in exts}
 
 
-def count_project(root: Path, extensions: set[str], ignore_dirs: set[str]):
+def count_project(
+    root: Path,
+    extensions: set[str],
+    ignore_dirs: set[str],
+    max_bytes: int = MAX_FILE_BYTES,
+):
+    files = list(iter_source_files(root, extensions, ignore_dirs, max_bytes))
+    paths = [path for path, _ in files]
     per_file = []
     total = 0
-    for file_path in iter_source_files(root, extensions, ignore_dirs):
-        loc = count_non_empty_lines(file_path)
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+        locs = list(pool.map(count_non_empty_lines, paths, chunksize=64))
+    for (_, rel), loc in zip(files, locs):
         if loc == 0:
             continue
-        rel = file_path.relative_to(root)
         per_file.append((loc, rel))
         total += loc
-    per_file.sort(reverse=True, key=lambda x: x[0])
+    return per_file, total
+
+
+# SQLite-backed LOC cache keyed by a file content fingerprint. Writes are not
+# committed one by one; flush() commits a batch and trims the table to the
+# max_rows most recently used entries.
+class LocCache:
+
+    def __init__(self, path: str | Path, max_rows: int = LOC_CACHE_MAX_ROWS):
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS loc (k TEXT PRIMARY KEY, loc INTEGER NOT NULL, used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS loc_used ON loc(used)")
+        self._conn.commit()
+        self._inserted = False
+
+    def get(self, key: str) -> int | None:
+        with self._lock:
+            row = self._conn.execute("SELECT loc FROM loc WHERE k = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE loc SET used = ? WHERE k = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key: str, loc: int) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO loc (k, loc, used) VALUES (?, ?, ?)",
+                (key, loc, time.time()),
+            )
+            self._inserted = True
+
+    def flush(self) -> None:
+        with self._lock:
+            # Only inserts can push the table over the cap; hits skip the trim.
+            if self._inserted:
+                self._inserted = False
+                (rows,) = self._conn.execute("SELECT COUNT(*) FROM loc").fetchone()
+                if rows > self.max_rows:
+                    self._conn.execute(
+                        "DELETE FROM loc WHERE k IN (SELECT k FROM loc ORDER BY used ASC LIMIT ?)",
+                        (rows - self.max_rows,),
+                    )
+            self._conn.commit()
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+
+def _zip_member_fingerprint(info: zipfile.ZipInfo) -> str:
+    # Size and CRC-32 come from the zip directory, so no decompression is needed.
+    return f"{info.file_size}:{info.CRC:08x}"
+
+
+def _zip_root_prefix(zip_ref: zipfile.ZipFile) -> str:
+    # GitHub archives wrap everything in a single "<owner>-<repo>-<sha>/" folder.
+    tops = {name.split("/", 1)[0] for name in zip_ref.namelist() if "/" in name}
+    return f"{tops.pop()}/" if len(tops) == 1 else ""
+
+
+def iter_zip_source_members(
+    zip_ref: zipfile.ZipFile,
+    extensions: set[str],
+    ignore_dirs: set[str],
+    subpath: str | None = None,
+    max_bytes: int = MAX_FILE_BYTES,
+):
+    prefix = _zip_root_prefix(zip_ref)
+    if subpath:
+        prefix = f"{prefix}{subpath.strip('/')}/"
+        if not any(name.startswith(prefix) for name in zip_ref.namelist()):
+            raise ValueError(f"Path not found in repository: {subpath}")
+
+    for info in zip_ref.infolist():
+        if info.is_dir() or not info.filename.startswith(prefix):
+            continue
+        rel = info.filename[len(prefix) :]
+        parts = rel.split("/")
+        if any(part in ignore_dirs for part in parts):
+            continue
+        if extensions:
+            name = parts[-1]
+            dot = name.rfind(".")
+            if dot <= 0 or name[dot:].lower() not in extensions:
+                continue
+        if max_bytes and info.file_size > max_bytes:
+            continue
+        yield info, rel
+
+
+def count_project_from_zip(
+    zip_ref: zipfile.ZipFile,
+    extensions: set[str],
+    ignore_dirs: set[str],
+    subpath: str | None = None,
+    max_bytes: int = MAX_FILE_BYTES,
+    cache: LocCache | None = None,
+):
+    per_file = []
+    total = 0
+    for info, rel in iter_zip_source_members(zip_ref, extensions, ignore_dirs, subpath, max_bytes):
+        key = _zip_member_fingerprint(info) if cache else None
+        loc = cache.get(key) if cache else None
+        if loc is None:
+            with zip_ref.open(info) as fh:
+                loc = _count_stream(fh)
+            if cache:
+                cache.put(key, loc)
+        if loc == 0:
+            continue
+        per_file.append((loc, rel))
+        total += loc
+    if cache:
+        cache.flush()
     return per_file, total
 
 
@@ -113,37 +321,59 @@ def parse_github_repo_url(url: str):
     return owner, repo, branch, subpath
 
 
-def download_and_extract_repo(url: str, temp_dir: Path) -> Path:
-    owner, repo, branch, subpath = parse_github_repo_url(url)
+def github_archive_url(owner: str, repo: str, branch: str | None = None, sha: str | None = None) -> str:
+    if sha:
+        return f"https://codeload.github.com/{owner}/{repo}/zip/{sha}"
     if branch:
         branch_path = urllib.parse.quote(branch, safe="/")
-        archive_url = f"https://codeload.github.com/{owner}/{repo}/zip/refs/heads/{branch_path}"
-    else:
-        archive_url = f"https://api.github.com/repos/{owner}/{repo}/zipball"
+        return f"https://codeload.github.com/{owner}/{repo}/zip/refs/heads/{branch_path}"
+    return f"https://api.github.com/repos/{owner}/{repo}/zipball"
 
-    zip_path = temp_dir / "repo.zip"
+
+def download_archive(archive_url: str, out_file) -> None:
     request = urllib.request.Request(
         archive_url,
-        headers={"User-Agent": "loc-counter-script"},
+        headers={"User-Agent": "loc-counter-script", "Accept-Encoding": "identity"},
     )
-    with urllib.request.urlopen(request) as response, zip_path.open("wb") as out_file:
-        out_file.write(response.read())
+    with urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT) as response:
+        shutil.copyfileobj(response, out_file, READ_CHUNK_BYTES)
+
 
+def download_repo_archive(url: str, out_file) -> str | None:
+    owner, repo, branch, subpath = parse_github_repo_url(url)
+    download_archive(github_archive_url(owner, repo, branch), out_file)
+    return subpath
+
+
+def download_and_extract_repo(
+    url: str,
+    temp_dir: Path,
+    extensions: set[str] = DEFAULT_EXTENSIONS,
+    ignore_dirs: set[str] = DEFAULT_IGNORE_DIRS,
+    max_bytes: int = MAX_FILE_BYTES,
+) -> Path:
+    zip_path = temp_dir / "repo.zip"
+    with zip_path.open("wb") as out_file:
+        subpath = download_repo_archive(url, out_file)
+
+    # Extract only the members that would be counted, with large copy buffers
+    # instead of extractall's small default ones.
     extract_dir = temp_dir / "extracted"
     extract_dir.mkdir(parents=True, exist_ok=True)
+    extract_root = extract_dir.resolve()
     with zipfile.ZipFile(zip_path, "r") as zip_ref:
-        zip_ref.extractall(extract_dir)
-
-    subdirs = [p for p in extract_dir.iterdir() if p.is_dir()]
-    root = subdirs[0] if len(subdirs) == 1 else extract_dir
+        members = iter_zip_source_members(zip_ref, extensions, ignore_dirs, subpath, max_bytes)
+        for info, rel in members:
+            # Unlike extractall, nothing sanitises member names here. Resolving
+            # catches "..", absolute paths and Windows drive or backslash tricks.
+            dest = extract_dir.joinpath(*rel.split("/"))
+            if not dest.resolve().is_relative_to(extract_root):
+                continue
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            with zip_ref.open(info) as src, dest.open("wb") as dst:
+                shutil.copyfileobj(src, dst, READ_CHUNK_BYTES)
 
-    if subpath:
-        target = root.joinpath(*subpath.split("/"))
-        if not target.exists():
-            raise ValueError(f"Path not found in repository: {subpath}")
-        return target
-
-    return root
+    return extract_dir
 
 
 def main() -> int:
@@ -172,6 +402,12 @@ def main() -> int:
         default=20,
         help="How many top files by LOC to display (default: 20).",
     )
+    parser.add_argument(
+        "--max-bytes",
+        type=int,
+        default=MAX_FILE_BYTES,
+        help=f"Skip files larger than this many bytes, 0 = no limit (default: {MAX_FILE_BYTES}).",
+    )
     args = parser.parse_args()
     target = args.target
     if target is None:
@@ -186,22 +422,28 @@ def main() -> int:
         else:
             target = "."
 
-    extensions = normalize_extensions(parse_csv_set(args.ext)) if args.ext else set()
-    ignore_dirs = parse_csv_set(args.ignore_dirs)
+    extensions = frozenset(normalize_extensions(parse_csv_set(args.ext)) if args.ext else ())
+    ignore_dirs = frozenset(parse_csv_set(args.ignore_dirs))
 
     try:
         if is_http_url(target):
             with tempfile.TemporaryDirectory(prefix="loc_counter_") as tmp:
                 temp_dir = Path(tmp)
-                root = download_and_extract_repo(target, temp_dir)
-                per_file, total = count_project(root, extensions, ignore_dirs)
+                root = download_and_extract_repo(
+                    target, temp_dir, extensions, ignore_dirs, args.max_bytes
+                )
+                per_file, total = count_project(
+                    root, extensions, ignore_dirs, max_bytes=args.max_bytes
+                )
                 print(f"Source: {target}")
                 print(f"Project (temp): {root}")
         else:
             root = Path(target).resolve()
-            per_file, total = count_project(root, extensions, ignore_dirs)
+            per_file, total = count_project(
+                root, extensions, ignore_dirs, max_bytes=args.max_bytes
+            )
             print(f"Project: {root}")
-    except (ValueError, urllib.error.URLError, zipfile.BadZipFile) as exc:
+    except (ValueError, urllib.error.URLError, TimeoutError, zipfile.BadZipFile) as exc:
         print(f"Error: {exc}", file=sys.stderr)
         return 1
 
@@ -209,7 +451,7 @@ def main() -> int:
     print(f"Total non-empty LOC: {total}")
     print()
     print(f"Top {min(args.top, len(per_file))} files:")
-    for loc, rel in per_file[: args.top]:
+    for loc, rel in heapq.nlargest(args.top, per_file, key=itemgetter(0)):
         print(f"{loc:>8}  {rel}")
     return 0
 
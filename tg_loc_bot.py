@@ -1,13 +1,18 @@
 ﻿#!/usr/bin/env python3
 import asyncio
+import heapq
 import html
 import os
 import re
 import sys
 import tempfile
-import urllib.error
+import urllib.parse
 import zipfile
-from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+
+import httpx
 
 try:
     from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, Update
@@ -32,18 +37,38 @@ except ImportError as exc:
 from count_loc import (
     DEFAULT_EXTENSIONS,
     DEFAULT_IGNORE_DIRS,
-    count_project,
-    download_and_extract_repo,
+    DOWNLOAD_TIMEOUT,
+    READ_CHUNK_BYTES,
+    LocCache,
+    count_project_from_zip,
+    github_archive_url,
     normalize_extensions,
+    parse_github_repo_url,
 )
 
 
-URL_RE = re.compile(r"https?://[^\s]+", re.IGNORECASE)
+URL_RE = re.compile(r"https?://\S+", re.IGNORECASE)
 BTN_COUNT = "Порахувати LOC"
 BTN_TOP_10 = "Топ 10"
 BTN_TOP_20 = "Топ 20"
 BTN_HELP = "Допомога"
 BOT_TOKEN = ""
+LOC_CACHE_PATH = os.getenv("LOC_CACHE_PATH", "loc_cache.sqlite3")
+_EXTS = frozenset(normalize_extensions(set(DEFAULT_EXTENSIONS)))
+_IGN = frozenset(DEFAULT_IGNORE_DIRS)
+RESULT_CACHE_SIZE = 128
+MAX_TOP_FILES = 20
+MAX_CONCURRENT_COUNTS = 4
+
+# Heavy counts get their own pool and a concurrency cap so callbacks and
+# button taps stay responsive while large repositories are processed.
+_count_semaphore = asyncio.Semaphore(MAX_CONCURRENT_COUNTS)
+_count_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_COUNTS, thread_name_prefix="loc")
+
+# (owner, repo, branch, sha, subpath) -> (rows, file_count, total), least
+# recently used first. rows are the MAX_TOP_FILES largest files, already
+# formatted and HTML-escaped, so a refresh only slices them.
+_result_cache: OrderedDict = OrderedDict()
 
 
 def _main_keyboard() -> ReplyKeyboardMarkup:
@@ -64,35 +89,109 @@ def _inline_result_buttons() -> InlineKeyboardMarkup:
     )
 
 
-def _count_repo_from_url(url: str, top: int):
-    extensions = normalize_extensions(set(DEFAULT_EXTENSIONS))
-    ignore_dirs = set(DEFAULT_IGNORE_DIRS)
-    with tempfile.TemporaryDirectory(prefix="loc_counter_") as tmp:
-        root = download_and_extract_repo(url, Path(tmp))
-        per_file, total = count_project(root, extensions, ignore_dirs)
-    return per_file, total, top
+def _lru_get(cache: OrderedDict, key):
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
 
 
-def _render_result(url: str, per_file, total: int, top: int) -> str:
-    lines = [
-        f"Репозиторій: {url}",
-        f"Файлів пораховано: {len(per_file)}",
-        f"Загалом non-empty рядків: {total}",
-        "",
-        f"Топ {min(top, len(per_file))} файлів:",
-    ]
-    for loc, rel in per_file[:top]:
-        lines.append(f"{loc:>8}  {rel}")
-    return "\n".join(lines)
+def _lru_put(cache: OrderedDict, key, value) -> None:
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > RESULT_CACHE_SIZE:
+        cache.popitem(last=False)
 
 
-def _render_result_html(url: str, per_file, total: int, top: int) -> str:
-    text = _render_result(url, per_file, total, top)
-    safe_text = html.escape(text)
-    return f"<b>Результат підрахунку LOC</b>\n<pre>{safe_text}</pre>"
+def _get_cached_result(key):
+    return _lru_get(_result_cache, key)
+
+
+def _put_cached_result(key, result) -> None:
+    _lru_put(_result_cache, key, result)
+
+
+async def _resolve_commit_sha(
+    client: httpx.AsyncClient,
+    etags: OrderedDict,
+    owner: str,
+    repo: str,
+    branch: str | None,
+) -> str:
+    # etags maps (owner, repo, branch) -> (etag, sha). A 304 reply to the
+    # conditional request means the ref still points at the cached sha.
+    ref = urllib.parse.quote(branch, safe="/") if branch else "HEAD"
+    headers = {"Accept": "application/vnd.github.sha"}
+    known = _lru_get(etags, (owner, repo, branch))
+    if known is not None:
+        headers["If-None-Match"] = known[0]
+    response = await client.get(
+        f"https://api.github.com/repos/{owner}/{repo}/commits/{ref}",
+        headers=headers,
+    )
+    if response.status_code == 304 and known is not None:
+        return known[1]
+    response.raise_for_status()
+    sha = response.text.strip()
+    etag = response.headers.get("ETag")
+    if etag:
+        _lru_put(etags, (owner, repo, branch), (etag, sha))
+    return sha
+
+
+async def _download_archive(client: httpx.AsyncClient, archive_url: str, out_file) -> None:
+    async with client.stream("GET", archive_url, headers={"Accept-Encoding": "identity"}) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(READ_CHUNK_BYTES):
+            out_file.write(chunk)
+
+
+def _count_archive(archive, subpath: str | None, loc_cache: LocCache):
+    with zipfile.ZipFile(archive) as zip_ref:
+        return count_project_from_zip(zip_ref, _EXTS, _IGN, subpath, cache=loc_cache)
+
+
+async def _count_repo_from_url(bot_data: dict, url: str):
+    client = bot_data["http"]
+    owner, repo, branch, subpath = parse_github_repo_url(url)
+    sha = await _resolve_commit_sha(client, bot_data["commit_etags"], owner, repo, branch)
+    key = (owner, repo, branch, sha, subpath)
+    result = _get_cached_result(key)
+    if result is not None:
+        return key, result
+
+    with tempfile.TemporaryFile(prefix="loc_counter_") as archive:
+        await _download_archive(client, github_archive_url(owner, repo, sha=sha), archive)
+        archive.seek(0)
+        loop = asyncio.get_running_loop()
+        per_file, total = await loop.run_in_executor(
+            _count_executor, _count_archive, archive, subpath, bot_data["loc_cache"]
+        )
+    rows = [
+        f"{loc:>8}  {html.escape(rel)}"
+        for loc, rel in heapq.nlargest(MAX_TOP_FILES, per_file, key=itemgetter(0))
+    ]
+    result = (rows, len(per_file), total)
+    _put_cached_result(key, result)
+    return key, result
+
+
+def _render_result_html(url: str, result, top: int) -> str:
+    rows, file_count, total = result
+    shown = rows[:top]
+    header = (
+        f"Репозиторій: {html.escape(url)}\n"
+        f"Файлів пораховано: {file_count}\n"
+        f"Загалом non-empty рядків: {total}\n"
+        "\n"
+        f"Топ {len(shown)} файлів:\n"
+    )
+    return "<b>Результат підрахунку LOC</b>\n<pre>" + header + "\n".join(shown) + "</pre>"
 
 
 def _extract_url(text: str) -> str | None:
+    if "http" not in text.lower():
+        return None
     match = URL_RE.search(text)
     if not match:
         return None
@@ -107,21 +206,27 @@ def _set_user_top(context: ContextTypes.DEFAULT_TYPE, top: int) -> None:
     context.user_data["top"] = top
 
 
+async def _reply_result(update: Update, url: str, result, top: int) -> None:
+    await update.effective_message.reply_text(
+        _render_result_html(url, result, top),
+        parse_mode="HTML",
+        reply_markup=_inline_result_buttons(),
+    )
+
+
 async def _run_count(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str, top: int) -> None:
     context.user_data["last_url"] = url
+    context.user_data.pop("last_key", None)
     await update.effective_message.reply_text("Рахую рядки коду, зачекай...")
 
     try:
-        per_file, total, top = await asyncio.to_thread(_count_repo_from_url, url, top)
-        result_html = _render_result_html(url, per_file, total, top)
-        await update.effective_message.reply_text(
-            result_html,
-            parse_mode="HTML",
-            reply_markup=_inline_result_buttons(),
-        )
+        async with _count_semaphore:
+            key, result = await _count_repo_from_url(context.bot_data, url)
+        context.user_data["last_key"] = key
+        await _reply_result(update, url, result, top)
     except ValueError as exc:
         await update.effective_message.reply_text(f"Помилка: {exc}")
-    except (urllib.error.URLError, zipfile.BadZipFile) as exc:
+    except (httpx.HTTPError, zipfile.BadZipFile) as exc:
         await update.effective_message.reply_text(f"Не вдалося завантажити репозиторій: {exc}")
     except Exception as exc:
         await update.effective_message.reply_text(f"Невідома помилка: {exc}")
@@ -205,10 +310,31 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
     _set_user_top(context, top)
+    result = _get_cached_result(context.user_data.get("last_key"))
+    if result is not None:
+        await _reply_result(update, last_url, result, top)
+        return
+
     await query.message.reply_text(f"Оновлюю результат з налаштуванням: Топ {top}.")
     await _run_count(update, context, last_url, top)
 
 
+async def _post_init(app: Application) -> None:
+    app.bot_data["http"] = httpx.AsyncClient(
+        headers={"User-Agent": "loc-counter-bot"},
+        timeout=DOWNLOAD_TIMEOUT,
+        follow_redirects=True,
+    )
+    app.bot_data["loc_cache"] = LocCache(LOC_CACHE_PATH)
+    app.bot_data["commit_etags"] = OrderedDict()
+
+
+async def _post_shutdown(app: Application) -> None:
+    await app.bot_data["http"].aclose()
+    _count_executor.shutdown()
+    app.bot_data["loc_cache"].close()
+
+
 def main() -> int:
     token = BOT_TOKEN.strip() or os.getenv("TELEGRAM_BOT_TOKEN", "8091516058:AAEhkQEvHp8LUbSpC9tBszr5ZYMfLsIM9tE").strip()
     if not token:
@@ -218,7 +344,13 @@ def main() -> int:
         )
         return 1
 
-    app = Application.builder().token(token).build()
+    app = (
+        Application.builder()
+        .token(token)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_cmd))
     app.add_handler(CallbackQueryHandler(handle_callback))